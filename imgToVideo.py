@@ -1,8 +1,86 @@
 import os
+import functools
+import multiprocessing
+import queue
+import threading
 import cv2
+import numpy as np
+
+def fastBlur(img, size, kernelSize, passes = 3):
+    #kernelSize is measured in pixels of the output size
+    sigma = 0.3*((kernelSize - 1)*0.5 - 1) + 0.8
+
+    #a blur this wide removes every detail a thumbnail would lose, so blur a thumbnail and scale it back up;
+    #blurs with sigma under 4 stay at full resolution
+    width, height = size
+    downscale = max(1, int(sigma / 4))
+    small = cv2.resize(img, (max(1, width // downscale), max(1, height // downscale)), interpolation = cv2.INTER_AREA)
+    sigma /= downscale
+
+    #a box only a few pixels wide is too coarse to stand in for a Gaussian, and a small kernel is cheap anyway
+    if sigma < 2:
+        small = cv2.GaussianBlur(small, (kernelSize, kernelSize), 0)
+        return cv2.resize(small, (width, height), interpolation = cv2.INTER_LINEAR)
+
+    #stacked box filters approximate a Gaussian of the same sigma, at a cost independent of kernel size
+    idealBoxSize = (12*sigma*sigma/passes + 1) ** 0.5
+    boxSize = 2*int(round((idealBoxSize - 1) / 2)) + 1
+    for _ in range(passes):
+        small = cv2.blur(small, (boxSize, boxSize))
+    return cv2.resize(small, (width, height), interpolation = cv2.INTER_LINEAR)
+
+def removeStaleCaches(img_file, keepFile):
+    #drops caches left by earlier versions of the source, named <image>.<size>-<mtime>.raw.npy
+    directory, name = os.path.split(img_file)
+    keepName = os.path.basename(keepFile)
+    with os.scandir(directory or ".") as entries:
+        for entry in entries:
+            if entry.name == keepName or not entry.name.startswith(name + ".") or not entry.name.endswith(".raw.npy"):
+                continue
+            stamp = entry.name[len(name) + 1:-len(".raw.npy")]
+            if stamp.replace("-", "", 1).isdigit():
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+def readImage(img_file, cache = False):
+    if not cache:
+        return cv2.imread(img_file)
+
+    #opt-in for repeated runs over the same images: the decoded pixels are kept beside the source and
+    #mapped in instead of decoded again, at the cost of an uncompressed copy of every image on disk
+    try:
+        sourceStat = os.stat(img_file)
+    except OSError:
+        return cv2.imread(img_file)
+
+    #the name records the source's exact size and mtime, so any change to the source misses the cache
+    cacheFile = img_file + "." + str(sourceStat.st_size) + "-" + str(sourceStat.st_mtime_ns) + ".raw.npy"
+    try:
+        return np.load(cacheFile, mmap_mode = 'r')
+    except (OSError, ValueError, EOFError):
+        #a missing, unreadable or truncated cache only means decoding the image again
+        pass
 
-def scaleAndBlur(img_file, targetWidth = 1920, targetHeight = 1080, targetBlur = 195):
     img = cv2.imread(img_file)
+    if img is not None:
+        #written under a temporary name so an interrupted run never leaves a partial cache behind
+        tempFile = cacheFile + "." + str(os.getpid()) + ".tmp"
+        try:
+            with open(tempFile, 'wb') as f:
+                np.save(f, img)
+            os.replace(tempFile, cacheFile)
+            removeStaleCaches(img_file, cacheFile)
+        except OSError:
+            try:
+                os.remove(tempFile)
+            except OSError:
+                pass
+    return img
+
+def scaleAndBlur(img_file, targetWidth = 1920, targetHeight = 1080, targetBlur = 195, cacheDecode = False):
+    img = readImage(img_file, cacheDecode)
     imgData = img.shape
 
     initialWidth = imgData[1]
@@ -15,11 +93,9 @@ def scaleAndBlur(img_file, targetWidth = 1920, targetHeight = 1080, targetBlur =
     if initRatio > idealRatio:
         scaleFactor = targetWidth / initialWidth
         invScaleFactor = targetHeight / initialHeight
-        limitingDimension = "Width"
     else:
         scaleFactor = targetHeight / initialHeight
         invScaleFactor = targetWidth / initialWidth
-        limitingDimension = "Height"
 
     w_offset = ((targetWidth//2) - (initialWidth*scaleFactor//2))
     newData = (int(scaleFactor*initialWidth), int(scaleFactor*initialHeight))
@@ -27,16 +103,14 @@ def scaleAndBlur(img_file, targetWidth = 1920, targetHeight = 1080, targetBlur =
 
     if scaleFactor > 1:        
         scaled_img = cv2.resize(img, newData, interpolation = cv2.INTER_CUBIC)
-        inverted_scaled_img = cv2.resize(img, invNewData, interpolation = cv2.INTER_CUBIC)
     else:
         scaled_img = cv2.resize(img, newData, interpolation = cv2.INTER_AREA)
-        inverted_scaled_img = cv2.resize(img, invNewData, interpolation = cv2.INTER_CUBIC)
 
-    #changes blurred image depending on if image is wide or narrow
-    if initRatio > idealRatio:
-        blurred_img = cv2.GaussianBlur(inverted_scaled_img,(targetBlur,targetBlur),0)
-    else:
-        blurred_img = cv2.GaussianBlur(inverted_scaled_img,(targetBlur,targetBlur),0)
+    #an image with the target aspect ratio covers the whole frame, so no background is needed
+    if scaled_img.shape[:2] == (targetHeight, targetWidth):
+        return scaled_img
+
+    blurred_img = fastBlur(img, invNewData, targetBlur)
 
     x_offset = int(w_offset)
 
@@ -45,16 +119,20 @@ def scaleAndBlur(img_file, targetWidth = 1920, targetHeight = 1080, targetBlur =
     else:
         y_offset = 0
 
-    if initRatio > idealRatio:
-        blurred_img[y_offset:y_offset+scaled_img.shape[0], x_offset:x_offset+scaled_img.shape[1]] = scaled_img
-    else:
-        blurred_img[y_offset:y_offset+scaled_img.shape[0], x_offset:x_offset+scaled_img.shape[1]] = scaled_img
+    blurred_img[y_offset:y_offset+scaled_img.shape[0], x_offset:x_offset+scaled_img.shape[1]] = scaled_img
 
     final_img = blurred_img[0:targetHeight, 0:targetWidth]
-    cv2.destroyAllWindows()
-    cv2.destroyAllWindows()
     return final_img
 
+def alignedEmpty(shape, alignment = 64):
+    #contiguous uint8 array starting on a cache line, so vectorized loads and stores never split one
+    size = int(np.prod(shape))
+    raw = np.empty(size + alignment, dtype=np.uint8)
+    offset = -raw.ctypes.data % alignment
+    return raw[offset:offset + size].reshape(shape)
+
+#every yielded frame is a new array unless bufferCount is given; then frames come from a ring of
+#bufferCount reused buffers, and each frame must be consumed before bufferCount more are rendered
 def frames_from_image(
     image, 
     frameRate = 25,
@@ -62,36 +140,128 @@ def frames_from_image(
     zoomRate = 0.0004,
     targetWidth = 1920,
     targetHeight = 1080,
+    bufferCount = None,
 ):
     frameTotal = frameRate * imgDuration
-    framesFinal = []
 
-    for i in range(frameTotal):
-        currentScale = 1 + i*zoomRate
+    #frames are rendered into a ring of reused buffers, each one is overwritten bufferCount renders later
+    if bufferCount is not None:
+        frames = alignedEmpty((bufferCount, targetHeight, targetWidth, 3))
+
+    #the whole zoom schedule is computed up front
+    currentScale = 1 + np.arange(frameTotal)*zoomRate
+
+    horizontalOffset = ((currentScale - 1)*targetHeight).astype(int)
+    verticalOffset = ((currentScale - 1)*targetWidth).astype(int)
+
+    currentHeight = targetHeight + horizontalOffset*2
+    currentWidth = targetWidth + verticalOffset*2
+
+    #a source bigger than the most zoomed frame is shrunk once instead of being decimated by every warp
+    if frameTotal:
+        maxDimensions = (int(currentWidth.max()), int(currentHeight.max()))
+        if image.shape[1] > maxDimensions[0] and image.shape[0] > maxDimensions[1]:
+            image = cv2.resize(image, maxDimensions, interpolation = cv2.INTER_AREA)
+
+    #keeps the source image on the GPU for every frame when OpenCV was built with CUDA
+    useCuda = cv2.cuda.getCudaEnabledDeviceCount() > 0
+    if useCuda:
+        gpuImage = cv2.cuda_GpuMat()
+        gpuImage.upload(image)
+        gpuFrame = cv2.cuda_GpuMat(targetHeight, targetWidth, cv2.CV_8UC3)
+
+    #resize and crop in a single warp: scale to the current size, then shift by the crop offset
+    scaleX = currentWidth / image.shape[1]
+    scaleY = currentHeight / image.shape[0]
+    zoomMatrices = np.zeros((frameTotal, 2, 3), dtype=np.float32)
+    zoomMatrices[:, 0, 0] = scaleX
+    zoomMatrices[:, 0, 2] = 0.5*(scaleX - 1) - verticalOffset
+    zoomMatrices[:, 1, 1] = scaleY
+    zoomMatrices[:, 1, 2] = 0.5*(scaleY - 1) - horizontalOffset
 
-        horizontalOffset = int((currentScale - 1)*targetHeight)
-        verticalOffset = int((currentScale - 1)*targetWidth)
+    #the crop offsets are truncated to whole pixels, so slow zooms repeat the same matrix and the
+    #previous frame can be yielded again instead of rendered
+    needsRender = np.ones(frameTotal, dtype=bool)
+    needsRender[1:] = (zoomMatrices[1:] != zoomMatrices[:-1]).any(axis=(1, 2))
 
-        currentHeight = targetHeight + horizontalOffset*2
-        currentWidth = targetWidth + verticalOffset*2
-        currentDimensions = (currentWidth, currentHeight)
+    #an unscaled, unshifted frame is just the source image
+    identity = np.float32([[1, 0, 0], [0, 1, 0]])
+    sameSize = image.shape[:2] == (targetHeight, targetWidth)
 
-        currentFrame = cv2.resize(image, currentDimensions, interpolation=cv2.INTER_CUBIC)
+    renderCount = 0
+    for zoomMatrix, render in zip(zoomMatrices, needsRender):
+        if render:
+            if bufferCount is None:
+                frame = alignedEmpty((targetHeight, targetWidth, 3))
+            else:
+                frame = frames[renderCount % bufferCount]
+            renderCount += 1
+            if sameSize and (zoomMatrix == identity).all():
+                np.copyto(frame, image)
+            elif useCuda:
+                cv2.cuda.warpAffine(gpuImage, zoomMatrix, (targetWidth, targetHeight), dst=gpuFrame, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+                gpuFrame.download(frame)
+            else:
+                cv2.warpAffine(image, zoomMatrix, (targetWidth, targetHeight), dst=frame, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        elif bufferCount is None:
+            #a repeated frame is still handed out as its own array
+            frame = frame.copy()
+        yield frame
 
-        croppedFrame = currentFrame[horizontalOffset:targetHeight+horizontalOffset, verticalOffset:targetWidth+verticalOffset]
-        framesFinal.append(croppedFrame)
+def writeFrames(out, frameQueue, writeErrors):
+    #keeps draining after a failed write so the producer never blocks on a full queue
+    frame = frameQueue.get()
+    while frame is not None:
+        if not writeErrors:
+            try:
+                out.write(frame)
+            except Exception as error:
+                writeErrors.append(error)
+        frame = frameQueue.get()
 
-    return framesFinal
+def videoFromImage(file, bufferCount = 4, cacheDecode = False):
+    blurredImg = scaleAndBlur(file, cacheDecode = cacheDecode)
+    fileName = os.path.splitext(file)
+    out = cv2.VideoWriter((str(fileName[0])+'_video.mxf'),cv2.VideoWriter_fourcc(*'xdv7'), 25, (1920,1080))
+
+    #encodes on a second thread while the next frame is rendered, the queue is two short of the
+    #buffer ring so a frame is never overwritten while it is queued or being written
+    bufferCount = max(bufferCount, 3)
+    frameQueue = queue.Queue(maxsize = bufferCount - 2)
+    writeErrors = []
+    writer = threading.Thread(target = writeFrames, args = (out, frameQueue, writeErrors))
+    writer.start()
+    try:
+        for frame in frames_from_image(blurredImg, bufferCount = bufferCount):
+            if writeErrors:
+                break
+            frameQueue.put(frame)
+    finally:
+        frameQueue.put(None)
+        writer.join()
+        out.release()
+
+    if writeErrors:
+        raise writeErrors[0]
+
+def initWorker(threadsPerWorker):
+    #OpenCV starts a thread per core in every process unless told otherwise
+    cv2.setNumThreads(threadsPerWorker)
+
+def videosFromImages(imageFiles, cacheDecode = False):
+    if not imageFiles:
+        return
+
+    #one process per file, splitting the cores between them
+    cpuCount = os.cpu_count() or 1
+    workerCount = min(cpuCount, len(imageFiles))
+    with multiprocessing.Pool(workerCount, initializer=initWorker, initargs=(max(1, cpuCount // workerCount),)) as pool:
+        pool.map(functools.partial(videoFromImage, cacheDecode = cacheDecode), imageFiles)
 
 if __name__ == "__main__":
-    for file in os.listdir():
-        if file.endswith(".jpg") or file.endswith(".jpeg") or file.endswith(".png") or file.endswith(".JPG") or file.endswith(".PNG") or file.endswith(".jfif") or file.endswith(".webp"):
-            blurredImg = scaleAndBlur(file)
-            imgSequence = frames_from_image(blurredImg)
-            shortenedName = str(file)
-            fileName = os.path.splitext(file)
-            out = cv2.VideoWriter((str(fileName[0])+'_video.mxf'),cv2.VideoWriter_fourcc(*'xdv7'), 25, (1920,1080))
-
-            for i in range(len(imgSequence)):
-                out.write(imgSequence[i])
-            out.release()
+    imageExtensions = {".jpg", ".jpeg", ".png", ".jfif", ".webp"}
+    with os.scandir() as entries:
+        imageFiles = [entry.name for entry in entries if entry.is_file() and os.path.splitext(entry.name)[1].lower() in imageExtensions]
+
+    #IMGTOVIDEO_CACHE=1 keeps decoded images beside the sources to speed up repeated runs
+    videosFromImages(imageFiles, cacheDecode = os.environ.get("IMGTOVIDEO_CACHE") == "1")